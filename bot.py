@@ -1,18 +1,31 @@
+import asyncio
 import logging
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from operator import attrgetter
 from io import BytesIO
-from datetime import datetime, timedelta
-from typing import List, Tuple, Optional, Dict
+from datetime import datetime, time, timedelta
+from typing import List, Tuple, Optional, Dict, Union
 from dataclasses import dataclass
+from zoneinfo import ZoneInfo
 
+from aiolimiter import AsyncLimiter
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     filters,
     ConversationHandler,
     ContextTypes,
+    PicklePersistence,
+    AIORateLimiter,
 )
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import Table, TableStyle, Paragraph, Spacer, PageBreak, HRFlowable
@@ -24,20 +37,34 @@ from PIL import Image
 from reportlab.lib.units import mm
 from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate
 
-from database import add_entry, get_entries_for_period
-from config import TELEGRAM_BOT_TOKEN, FONT_PATH
-from constants import ConversationState, NUTRIENT_LIMITS, MESSAGES, MEAL_TIMES
+from database import (
+    add_entry,
+    get_daily_totals_for_period,
+    save_reminders,
+    get_reminder_chat_ids,
+)
+from config import (
+    TELEGRAM_BOT_TOKEN,
+    FONT_PATH,
+    LOG_LEVEL,
+    DEV,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+)
+from constants import ConversationState, NUTRIENT_LIMITS, NUTRIENT_KEYS, MESSAGES, MEAL_TIMES
 from nutrition_analyzer import NutritionAnalyzer
 
-import pytz
-
 # Определяем московский часовой пояс
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+MOSCOW_TZ = ZoneInfo('Europe/Moscow')
+
+# Время ежедневных напоминаний о приёмах пищи
+REMINDER_TIMES = tuple(time(hour, 0, tzinfo=MOSCOW_TZ) for hour in (8, 12, 18))
 
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
+    level=LOG_LEVEL
 )
 logger = logging.getLogger('bot')
 
@@ -46,14 +73,45 @@ SET_PROTEIN, SET_VEGETABLES, SET_FATS, SET_FRUITS, SET_DAIRY, SET_GRAINS = range
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_NAME = os.path.join(BASE_DIR, 'food_diary.db')
+IMAGES_DIR = os.path.join(BASE_DIR, 'images')
+REPORTS_DIR = os.path.join(BASE_DIR, 'reports')
+STATE_FILE = os.path.join(BASE_DIR, 'bot_state.pkl')
+
+# Каталоги для фотографий и отчётов создаются один раз при запуске
+os.makedirs(IMAGES_DIR, exist_ok=True)
+os.makedirs(REPORTS_DIR, exist_ok=True)
+
+# Клавиатуры не меняются между вызовами, поэтому создаются один раз при импорте
+START_MARKUP = ReplyKeyboardMarkup(
+    [
+        ['/add', '/view'],
+        ['/stats', '/set_norms'],
+        ['/reminders', '/cancel']
+    ],
+    resize_keyboard=True
+)
+# Приёмы пищи разбиты на строки по 2 элемента
+MEAL_MARKUP = ReplyKeyboardMarkup(
+    [MEAL_TIMES[i:i + 2] for i in range(0, len(MEAL_TIMES), 2)],
+    one_time_keyboard=True,
+    resize_keyboard=True
+)
 
-def register_cyrillic_font():
+# Фильтры собираются один раз и переиспользуются всеми состояниями диалогов
+TEXT_NOCMD = filters.TEXT & ~filters.COMMAND
+# В состоянии загрузки фото /done обрабатывает отдельный CommandHandler
+UPLOAD_FILTER = filters.PHOTO | TEXT_NOCMD
+
+# Шрифты регистрируются в pdfmetrics глобально, поэтому достаточно одного раза на процесс
+@lru_cache(maxsize=1)
+def register_cyrillic_font() -> bool:
     """
     Регистрирует шрифт, поддерживающий кириллицу.
     Возвращает True при успешной регистрации, иначе False.
+    Результат кэшируется, повторные вызовы ничего не делают.
     """
     if not os.path.exists(FONT_PATH):
-        logger.error(f"Шрифт не найден по пути: {FONT_PATH}")
+        logger.error("Шрифт не найден по пути: %s", FONT_PATH)
         return False
 
     try:
@@ -73,41 +131,28 @@ def register_cyrillic_font():
         logger.info("Шрифт успешно зарегистрирован.")
         return True
     except Exception as e:
-        logger.error(f"Ошибка при регистрации шрифта: {e}")
+        logger.error("Ошибка при регистрации шрифта: %s", e)
         return False
 
+# Регистрируем шрифт при импорте, в том числе в рабочих процессах сборки отчётов
+register_cyrillic_font()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик команды /start. Отправляет приветственное сообщение и отображает клавиатуру с основными командами.
     """
     logger.debug("Вызван обработчик /start")
     user = update.effective_user
-    # Создаем клавиатуру с кнопками
-    keyboard = [
-        ['/add', '/view'],
-        ['/stats', '/set_norms'],
-        ['/reminders', '/cancel']
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text(MESSAGES['welcome'], reply_markup=reply_markup)
-    logger.info(f"Пользователь {user.id} начал взаимодействие с ботом.")
+    await update.message.reply_text(MESSAGES['welcome'], reply_markup=START_MARKUP)
+    logger.info("Пользователь %s начал взаимодействие с ботом.", user.id)
 
 async def add_entry_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Начинает процесс добавления новой записи о приёме пищи.
     Предлагает выбрать приём пищи из доступных вариантов.
     """
-    # Разбиваем MEAL_TIMES на строки по 2 элемента
-    reply_keyboard = [MEAL_TIMES[i:i + 2] for i in range(0, len(MEAL_TIMES), 2)]
-    await update.message.reply_text(
-        MESSAGES['choose_meal'],
-        reply_markup=ReplyKeyboardMarkup(
-            reply_keyboard,
-            one_time_keyboard=True,
-            resize_keyboard=True
-        )
-    )
-    logger.info(f"Пользователь {update.effective_user.id} начал добавление записи.")
+    await update.message.reply_text(MESSAGES['choose_meal'], reply_markup=MEAL_MARKUP)
+    logger.info("Пользователь %s начал добавление записи.", update.effective_user.id)
     return ConversationState.CHOOSE_MEAL.value
 
 async def choose_meal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -117,56 +162,57 @@ async def choose_meal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     meal_time = update.message.text
     if meal_time not in MEAL_TIMES:
         await update.message.reply_text(MESSAGES['invalid_meal'])
-        logger.warning(f"Пользователь {update.effective_user.id} выбрал некорректный приём пищи: {meal_time}")
+        logger.warning("Пользователь %s выбрал некорректный приём пищи: %s", update.effective_user.id, meal_time)
         return ConversationState.CHOOSE_MEAL.value
 
     context.user_data['meal_time'] = meal_time
-    context.user_data['current_state'] = ConversationState.UPLOAD_PHOTO.value
+    context.user_data['current_state'] = ConversationState.UPLOAD_PHOTO
     await update.message.reply_text(
         MESSAGES['send_photo'],
         reply_markup=ReplyKeyboardRemove()
     )
-    logger.info(f"Пользователь {update.effective_user.id} выбрал приём пищи: {meal_time}")
+    logger.info("Пользователь %s выбрал приём пищи: %s", update.effective_user.id, meal_time)
     return ConversationState.UPLOAD_PHOTO.value
 
+async def finish_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Завершает загрузку фотографий по команде /done и переходит к вводу порций.
+    """
+    context.user_data['current_state'] = ConversationState.ENTER_PROTEIN
+    await update.message.reply_text("Введите количество Белков (в порциях):")
+    return ConversationState.ENTER_PROTEIN.value
+
 async def upload_photos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Обрабатывает загрузку фотографий пользователем. Пользователь может отправить несколько фотографий.
+    Команду /done обрабатывает finish_upload, сюда попадают только фото и обычный текст.
     """
-    # Обработка команды /done
-    if update.message.text and update.message.text.lower() == '/done':
-        context.user_data['current_state'] = ConversationState.ENTER_PROTEIN.value
-        await update.message.reply_text("Введите количество Белков (в порциях):")
-        return ConversationState.ENTER_PROTEIN.value
-
     # Обработка фотографии
-    elif update.message.photo:
+    if update.message.photo:
         photo = update.message.photo[-1]
         try:
             file = await photo.get_file()
-            file_bytes = BytesIO()
-            await file.download_to_memory(out=file_bytes)
-            file_bytes.seek(0)
         except Exception as e:
-            logger.error(f"Ошибка при получении файла фотографии: {e}")
+            logger.error("Ошибка при получении файла фотографии: %s", e)
             await update.message.reply_text("Произошла ошибка при получении фотографии. Попробуйте снова.")
             return ConversationState.UPLOAD_PHOTO.value
 
-        # Сохранение изображения локально
+        # Сохранение изображения локально: файл пишется на диск потоком, без буфера в памяти.
+        # Фото из одного альбома приходят в ту же секунду, поэтому в имя добавляется file_unique_id
         user_id = update.effective_user.id
         timestamp = datetime.now(MOSCOW_TZ).strftime("%Y%m%d%H%M%S")
-        image_path = f"images/{user_id}_{timestamp}.jpg"
+        image_path = os.path.join(IMAGES_DIR, f"{user_id}_{timestamp}_{photo.file_unique_id}.jpg")
         try:
-            os.makedirs(os.path.dirname(image_path), exist_ok=True)
-            with open(image_path, 'wb') as f:
-                f.write(file_bytes.read())
+            await file.download_to_drive(custom_path=image_path)
+            # Уменьшенная копия для отчётов готовится сразу, чтобы не декодировать оригинал при каждом отчёте
+            await asyncio.to_thread(create_thumbnail, image_path)
             context.user_data.setdefault('image_paths', []).append(image_path)
-            logger.info(f"Фотография сохранена по пути: {image_path}")
+            logger.info("Фотография сохранена по пути: %s", image_path)
             await update.message.reply_text(
                 "📷 Фотография сохранна. Вы можете отправить ещё фотографию или введите /done, чтобы продолжить."
             )
         except Exception as e:
-            logger.error(f"Ошибка при сохранении фотографии: {e}")
+            logger.error("Ошибка при сохранении фотографии: %s", e)
             await update.message.reply_text("Произошла ошибка при сохранении фотографии.")
             return ConversationState.UPLOAD_PHOTO.value
 
@@ -176,6 +222,15 @@ async def upload_photos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text("Пожалуйста, отправьте фотографию или введите /done, чтобы продолжить.")
         return ConversationState.UPLOAD_PHOTO.value
 
+def _parse_portions(text: str) -> Optional[int]:
+    """
+    Разбирает введённое количество порций. Возвращает None, если введено не целое неотрицательное число.
+    """
+    # isdecimal() вместо try/except: опечатки не выбрасывают исключений,
+    # а после проверки int() всегда успешен (isdigit() пропустил бы, например, '²')
+    text = text.strip()
+    return int(text) if text.isdecimal() else None
+
 class NutrientInputHandler:
     """
     Класс для обработки ввода количества порций пищевых групп.
@@ -189,22 +244,36 @@ class NutrientInputHandler:
             ConversationState.ENTER_DAIRY: ('dairy', "Молочных продуктов"),
             ConversationState.ENTER_GRAINS: ('grains', "Злаков")
         }
+        # Порядок ввода и переходы между состояниями вычисляются один раз
+        self._order = tuple(self.nutrients.keys())
+        self._next = {
+            state: self._order[i + 1] if i + 1 < len(self._order) else None
+            for i, state in enumerate(self._order)
+        }
+        # Подсказки для ввода каждой пищевой группы форматируются заранее
+        self._prompts = {
+            state: MESSAGES['enter_amount'].format(nutrient_name=name)
+            for state, (_, name) in self.nutrients.items()
+        }
+        # Ключ, название и допустимый диапазон каждого состояния в одной записи
+        self._state_info = {
+            state: (key, name, *NUTRIENT_LIMITS[key])
+            for state, (key, name) in self.nutrients.items()
+        }
 
-    def validate_nutrient(self, value: str, nutrient_type: str) -> Tuple[bool, Optional[int], Optional[str]]:
+    def validate_nutrient(self, value: str, min_val: int, max_val: int) -> Tuple[bool, Optional[int], Optional[str]]:
         """
-        Проверяет корректность введенного значения для пищевой группы.
+        Проверяет, что введено целое число в допустимом диапазоне для пищевой группы.
         """
-        try:
-            value = int(value)
-            min_val, max_val = NUTRIENT_LIMITS[nutrient_type]
-            
-            if not (min_val <= value <= max_val):
-                return False, None, f"Значение должно быть между {min_val} и {max_val} порций"
-                
-            return True, value, None
-        except ValueError:
+        value = _parse_portions(value)
+        if value is None:
             return False, None, "Пожалуйста, введите целое число"
 
+        if not (min_val <= value <= max_val):
+            return False, None, f"Значение должно быть между {min_val} и {max_val} порций"
+
+        return True, value, None
+
     async def handle_input(
         self, 
         update: Update, 
@@ -213,12 +282,14 @@ class NutrientInputHandler:
         """
         Обрабатывает ввод пользоателя для текущего состояния и переходит к следующему.
         """
-        current_state = ConversationState(context.user_data['current_state'])
-        nutrient_key, nutrient_name = self.nutrients[current_state]
+        # В user_data хранится само состояние, поэтому Enum не нужно восстанавливать из числа
+        current_state = context.user_data['current_state']
+        nutrient_key, nutrient_name, min_val, max_val = self._state_info[current_state]
         
         is_valid, value, error_message = self.validate_nutrient(
             update.message.text, 
-            nutrient_key
+            min_val,
+            max_val
         )
         
         if not is_valid:
@@ -226,24 +297,19 @@ class NutrientInputHandler:
             return current_state.value
             
         context.user_data[nutrient_key] = value
-        logger.info(f"Пользователь {update.effective_user.id} ввёл {nutrient_name}: {value} порций")
+        logger.info("Пользователь %s ввёл %s: %s порций", update.effective_user.id, nutrient_name, value)
         
         # Определяем следующее состояние
-        states = list(self.nutrients.keys())
-        current_idx = states.index(current_state)
+        next_state = self._next[current_state]
         
-        if current_idx == len(states) - 1:
+        if next_state is None:
             # Если это последний nutrient, сохраняем запись
             await self._save_entry(update, context)
             return ConversationHandler.END
             
         # Иначе переходим к следующему nutrient
-        next_state = states[current_idx + 1]
-        context.user_data['current_state'] = next_state.value
-        _, next_nutrient_name = self.nutrients[next_state]
-        await update.message.reply_text(
-            MESSAGES['enter_amount'].format(nutrient_name=next_nutrient_name)
-        )
+        context.user_data['current_state'] = next_state
+        await update.message.reply_text(self._prompts[next_state])
         return next_state.value
 
     async def _save_entry(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -251,21 +317,19 @@ class NutrientInputHandler:
         Сохраняет запись в базу данных после ввода всех данных.
         """
         user_id = update.effective_user.id
-        date = datetime.now(MOSCOW_TZ).strftime("%Y-%m-%d")
-        timestamp = datetime.now(MOSCOW_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        now = datetime.now(MOSCOW_TZ)
+        date = now.strftime("%Y-%m-%d")
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
 
         image_paths = context.user_data.get('image_paths', [])
         
-        add_entry(
+        # Запись в SQLite выполняется в пуле потоков, чтобы не блокировать цикл событий
+        await asyncio.to_thread(
+            add_entry,
             user_id=user_id,
             date=date,
             meal_time=context.user_data['meal_time'],
-            protein=context.user_data.get('protein', 0),
-            vegetables=context.user_data.get('vegetables', 0),
-            fats=context.user_data.get('fats', 0),
-            fruits=context.user_data.get('fruits', 0),
-            dairy=context.user_data.get('dairy', 0),
-            grains=context.user_data.get('grains', 0),
+            **{key: context.user_data.get(key, 0) for key in NUTRIENT_KEYS},
             image_paths=image_paths,
             timestamp=timestamp
         )
@@ -273,7 +337,7 @@ class NutrientInputHandler:
         await update.message.reply_text(
             MESSAGES['entry_added'].format(meal_time=context.user_data['meal_time'])
         )
-        logger.info(f"Запись успешно сохранена для пользователя {user_id}.")
+        logger.info("Запись успешно сохранена для пользователя %s.", user_id)
 
         # Очистка image_paths для следующего входа
         context.user_data.pop('image_paths', None)
@@ -285,7 +349,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text(
         "Добавление записи отменено.", reply_markup=ReplyKeyboardRemove()
     )
-    logger.info(f"Пользователь {update.effective_user.id} отменил добавление записи.")
+    logger.info("Пользователь %s отменил добавление записи.", update.effective_user.id)
     return ConversationHandler.END
 
 @dataclass
@@ -303,6 +367,245 @@ class DiaryEntry:
     image_paths: List[str]
     timestamp: datetime
 
+# Порции записи в порядке NUTRIENT_KEYS одним вызовом на C-уровне
+_get_portions = attrgetter(*NUTRIENT_KEYS)
+
+@lru_cache(maxsize=1)
+def _get_styles() -> dict:
+    """
+    Создаёт и возвращает стили для PDF-документа.
+    Стили не зависят от пользователя, поэтому создаются один раз на процесс.
+    """
+    styles = getSampleStyleSheet()
+    
+    # Обновляем заголовок отчёта
+    styles.add(ParagraphStyle(
+        name='CenterTitle',
+        alignment=1,
+        fontName='CustomCyrillicFont-Bold',
+        fontSize=26,
+        spaceAfter=20,
+        textColor=colors.HexColor('#1F618D'),  # Более насыщенный синий
+    ))
+    
+    # Нормы потребления
+    styles.add(ParagraphStyle(
+        name='Norms',
+        alignment=0,  # ыравнивание по левому краю
+        fontName='CustomCyrillicFont-Bold',
+        fontSize=14,
+        spaceAfter=10,
+        textColor=colors.HexColor('#2C3E50'),  # Тёмно-синий
+        wordWrap='CJK'  # Добавлено свойство переноса
+    ))
+    
+    # Подзаголовки
+    styles.add(ParagraphStyle(
+        name='SubTitle',
+        fontName='CustomCyrillicFont-Bold',
+        fontSize=16,
+        spaceAfter=10,
+        textColor=colors.HexColor('#34495E'),  # Серовато-синий
+        wordWrap='CJK'  # Добавлено свойство переноса
+    ))
+    
+    # Стиль для текста в ячейках таблицы
+    styles.add(ParagraphStyle(
+        name='TableCell',
+        fontName='CustomCyrillicFont',
+        fontSize=10,
+        alignment=0,  # Выравнивание по левому краю
+        leading=12,
+        wordWrap='CJK',
+        splitLongWords=True,
+        hyphenationLang='ru'  # Язык для переноса слов
+    ))
+    
+    # Стиль для заголовков таблицы
+    styles.add(ParagraphStyle(
+        name='TableHeader',
+        fontName='CustomCyrillicFont-Bold',
+        fontSize=11,
+        alignment=1,  # Центрирование
+        textColor=colors.white,
+        wordWrap='CJK'  # Добавлено свойство переноса
+    ))
+    
+    # Стиль для подписей к фото
+    styles.add(ParagraphStyle(
+        name='PhotoCaption',
+        fontName='CustomCyrillicFont',
+        fontSize=12,
+        alignment=1,  # Ц��нтрирование
+        spaceAfter=5,
+        textColor=colors.HexColor('#2980B9'),  # Синий
+        wordWrap='CJK'  # Добавлено свойство переноса
+    ))
+    
+    # Стиль для рекомендаций
+    styles.add(ParagraphStyle(
+        name='Recommendation',
+        fontName='CustomCyrillicFont',
+        fontSize=12,
+        spaceAfter=10,
+        leftIndent=20,
+        bulletIndent=10,
+        textColor=colors.HexColor('#7F8C8D'),  # Серый
+        wordWrap='CJK'  # Добавлено свойство переноса
+    ))
+    
+    return styles
+
+# Стиль таблицы одинаков для всех отчётов
+_TABLE_STYLE = TableStyle([
+    # Общие настройки
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#BDC3C7')),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#34495E')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+    # Выравнивание и шрифты
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('FONTNAME', (0, 0), (-1, -1), 'CustomCyrillicFont'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    # Отступы
+    ('LEFTPADDING', (0, 0), (-1, -1), 6),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+    ('TOPPADDING', (0, 0), (-1, -1), 8),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+    # Цвет фона для чётных строк
+    ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#ECF0F1')),
+    ('BACKGROUND', (0, 2), (-1, -1), colors.white),
+    # Заголовок и строка итогов: полужирный белый текст на тёмном фоне
+    ('FONTNAME', (0, 0), (-1, 0), 'CustomCyrillicFont-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 11),
+    ('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#34495E')),
+    ('TEXTCOLOR', (0, -1), (-1, -1), colors.white),
+    ('FONTNAME', (0, -1), (-1, -1), 'CustomCyrillicFont-Bold'),
+    ('FONTSIZE', (0, -1), (-1, -1), 11),
+])
+
+@lru_cache(maxsize=256)
+def format_norms_text(protein, vegetables, fats, fruits, dairy, grains) -> str:
+    """
+    Формирует текст норм потребления для отчёта.
+    У большинства пользователей нормы совпадают, поэтому текст кэшируется.
+    """
+    return (
+        "Ваши ежедневные нормы потребления:\n"
+        f"• Белки: {protein} порций\n"
+        f"• Овощи: {vegetables} порций\n"
+        f"• Жиры: {fats} порций\n"
+        f"• Фрукты: {fruits} порций\n"
+        f"• Молочные продукты: {dairy} порций\n"
+        f"• Злаки: {grains} порций"
+    )
+
+# Текст норм для отчёта, когда нормы не заданы
+EMPTY_NORMS_TEXT = format_norms_text(*['?'] * 6)
+
+# Отчёты, которые собираются прямо сейчас, по ключу (user_id, date)
+_pending_reports: Dict[Tuple[int, str], asyncio.Future] = {}
+
+# Пул процессов для сборки PDF: ReportLab держит GIL во время вёрстки,
+# поэтому потоки не дают параллельности. Создаётся при первом отчёте.
+# Каждый рабочий процесс загружает telegram, reportlab и PIL, поэтому их немного
+REPORT_WORKERS = 2
+_report_executor: Optional[ProcessPoolExecutor] = None
+
+def _get_report_executor() -> ProcessPoolExecutor:
+    """
+    Возвращает общий пул процессов для сборки PDF-отчётов.
+    Рабочие процессы запускаются через forkserver (на Windows — spawn): fork процесса
+    с работающим циклом событий и потоками может повесить дочерний процесс.
+    """
+    global _report_executor
+    if _report_executor is None:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _report_executor = ProcessPoolExecutor(
+            max_workers=REPORT_WORKERS,
+            mp_context=multiprocessing.get_context(method)
+        )
+    return _report_executor
+
+def _discard_report_executor(executor: ProcessPoolExecutor) -> None:
+    """
+    Сбрасывает сломанный пул (рабочий процесс упал), чтобы следующий отчёт создал новый.
+    Пул сбрасывается, только если его ещё не заменил другой отчёт.
+    """
+    global _report_executor
+    if _report_executor is executor:
+        _report_executor = None
+        executor.shutdown(wait=False)
+
+async def _shutdown_report_executor(application: Application) -> None:
+    """
+    Останавливает пул процессов для сборки PDF при завершении бота.
+    """
+    global _report_executor
+    if _report_executor is not None:
+        # Пул останавливается в отдельном потоке, чтобы не блокировать цикл событий
+        await asyncio.to_thread(_report_executor.shutdown)
+        _report_executor = None
+
+def _build_report(user_id: int, date: str, user_norms: Optional[Dict[str, int]],
+                  entries: List['DiaryEntry'], prepared_images: List[Optional[tuple]]) -> str:
+    """
+    Собирает PDF-отчёт в рабочем процессе пула.
+    Генератор создаётся заново, чтобы шрифты и стили были зарегистрированы в этом процессе.
+    """
+    return PDFReportGenerator(user_id, date, user_norms)._build_sync(entries, prepared_images)
+
+# Заголовки столбцов таблицы. Заголовки и итоги не переносятся, поэтому передаются
+# строками без Paragraph: их оформление задаёт _TABLE_STYLE
+_TABLE_HEADER_ROW = ('Приём пищи', 'Белки', 'Овощи', 'Жиры', 'Фрукты', 'Молока', 'Злаки', 'Время')
+
+# Ширина фотографии в отчёте; более крупные снимки уменьшаются до неё
+REPORT_IMAGE_WIDTH = 400
+
+def thumbnail_path(image_path: str) -> str:
+    """
+    Возвращает путь к уменьшенной копии фотографии для отчётов.
+    """
+    return f"{os.path.splitext(image_path)[0]}_thumb.jpg"
+
+def _shrink_to_report_width(img: Image.Image) -> Image.Image:
+    """
+    Уменьшает изображение до ширины фотографии в отчёте.
+    draft() заставляет JPEG-декодер уменьшать изображение уже при декодировании.
+    """
+    target_size = (REPORT_IMAGE_WIDTH, max(1, round(REPORT_IMAGE_WIDTH * img.height / img.width)))
+    img.draft('RGB', target_size)
+    img.thumbnail(target_size)
+    return img.convert('RGB')
+
+def create_thumbnail(image_path: str) -> Optional[str]:
+    """
+    Сохраняет рядом с фотографией уменьшенную копию, чтобы отчёты не декодировали оригинал.
+    Для фотографий не шире отчёта копия не нужна. Вызывается в пуле потоков при загрузке.
+    """
+    try:
+        with Image.open(image_path) as img:
+            if img.width <= REPORT_IMAGE_WIDTH:
+                return None
+            thumb_path = thumbnail_path(image_path)
+            _shrink_to_report_width(img).save(thumb_path, format='JPEG', quality=85)
+    except Exception as e:
+        logger.error("Ошибка при создании миниатюры %s: %s", image_path, e)
+        return None
+    return thumb_path
+
+# Пропорции ширины столбцов таблицы
+COL_RATIOS = (1.5, 1, 1, 1, 1, 1.2, 1, 1.2)
+MIN_COL_WIDTH = 100  # Минимальная ширина столбца
+
+@lru_cache(maxsize=None)
+def compute_col_widths(page_width: float) -> Tuple[float, ...]:
+    """
+    Рассчитывает ширины столбцов таблицы пропорционально ширине страницы.
+    """
+    total_ratio = sum(COL_RATIOS)
+    return tuple(max((ratio / total_ratio) * page_width, MIN_COL_WIDTH) for ratio in COL_RATIOS)
+
 class PDFReportGenerator:
     """
     Класс для генерации PDF-отчёта на основе записей дневника.
@@ -310,179 +613,49 @@ class PDFReportGenerator:
     def __init__(self, user_id: int, date: str, user_norms: Dict[str, int] = None):
         self.user_id = user_id
         self.date = date
-        self.pdf_path = f"reports/{user_id}_{date}.pdf"
-        # Регистрируем шрифт перед созданием стилей
-        if not register_cyrillic_font():
-            logger.error("Ошибка при регистрации шрифта.")
-        self.styles = self._create_styles()
-        self.nutrition_analyzer = NutritionAnalyzer(user_norms)
-
-    def _create_styles(self) -> dict:
-        """
-        Создаёт и возвращает стили для PDF-документа.
-        """
-        styles = getSampleStyleSheet()
-        
-        # Обновляем заголовок отчёта
-        styles.add(ParagraphStyle(
-            name='CenterTitle',
-            alignment=1,
-            fontName='CustomCyrillicFont-Bold',
-            fontSize=26,
-            spaceAfter=20,
-            textColor=colors.HexColor('#1F618D'),  # Более насыщенный синий
-        ))
-        
-        # Нормы потребления
-        styles.add(ParagraphStyle(
-            name='Norms',
-            alignment=0,  # ыравнивание по левому краю
-            fontName='CustomCyrillicFont-Bold',
-            fontSize=14,
-            spaceAfter=10,
-            textColor=colors.HexColor('#2C3E50'),  # Тёмно-синий
-            wordWrap='CJK'  # Добавлено свойство переноса
-        ))
-        
-        # Подзаголовки
-        styles.add(ParagraphStyle(
-            name='SubTitle',
-            fontName='CustomCyrillicFont-Bold',
-            fontSize=16,
-            spaceAfter=10,
-            textColor=colors.HexColor('#34495E'),  # Серовато-синий
-            wordWrap='CJK'  # Добавлено свойство переноса
-        ))
-        
-        # Стиль для текста в ячейках таблицы
-        styles.add(ParagraphStyle(
-            name='TableCell',
-            fontName='CustomCyrillicFont',
-            fontSize=10,
-            alignment=0,  # Выравнивание по левому краю
-            leading=12,
-            wordWrap='CJK',
-            splitLongWords=True,
-            hyphenationLang='ru'  # Язык для переноса слов
-        ))
-        
-        # Стиль для заголовков таблицы
-        styles.add(ParagraphStyle(
-            name='TableHeader',
-            fontName='CustomCyrillicFont-Bold',
-            fontSize=11,
-            alignment=1,  # Центрирование
-            textColor=colors.white,
-            wordWrap='CJK'  # Добавлено свойство переноса
-        ))
-        
-        # Стиль для подписей к фото
-        styles.add(ParagraphStyle(
-            name='PhotoCaption',
-            fontName='CustomCyrillicFont',
-            fontSize=12,
-            alignment=1,  # Ц��нтрирование
-            spaceAfter=5,
-            textColor=colors.HexColor('#2980B9'),  # Синий
-            wordWrap='CJK'  # Добавлено свойство переноса
-        ))
-        
-        # Стиль для рекомендаций
-        styles.add(ParagraphStyle(
-            name='Recommendation',
-            fontName='CustomCyrillicFont',
-            fontSize=12,
-            spaceAfter=10,
-            leftIndent=20,
-            bulletIndent=10,
-            textColor=colors.HexColor('#7F8C8D'),  # Серый
-            wordWrap='CJK'  # Добавлено свойство переноса
-        ))
-        
-        return styles
+        self.user_norms = user_norms
+        self.pdf_path = os.path.join(REPORTS_DIR, f"{user_id}_{date}.pdf")
+        self.styles = _get_styles()
+        # Без пользовательских норм рекомендации в отчёт не попадают, анализатор не нужен
+        self.nutrition_analyzer = NutritionAnalyzer(user_norms) if user_norms else None
 
     def _create_table_style(self) -> TableStyle:
         """
-        Создаёт и возвращает стиль для таблицы в отчёте.
+        Возвращает стиль для таблицы в отчёте.
         """
-        return TableStyle([
-            # Общие настройки
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#BDC3C7')),
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#34495E')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-            # Выравнивание и шрифты
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('FONTNAME', (0, 0), (-1, -1), 'CustomCyrillicFont'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            # Отступы
-            ('LEFTPADDING', (0, 0), (-1, -1), 6),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 6),
-            ('TOPPADDING', (0, 0), (-1, -1), 8),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-            # Цвет фона для чётных строк
-            ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#ECF0F1')),
-            ('BACKGROUND', (0, 2), (-1, -1), colors.white),
-        ])
+        return _TABLE_STYLE
 
     def _create_table_data(self, entries: List[DiaryEntry]) -> Tuple[List[List[str]], dict]:
         """
         Создаёт данные для таблицы и считает итоги потребления.
         """
         # Заголовки столбцов
-        data = [[
-            Paragraph('Приём пищи', self.styles['TableHeader']),
-            Paragraph('Белки', self.styles['TableHeader']),
-            Paragraph('Овощи', self.styles['TableHeader']),
-            Paragraph('Жиры', self.styles['TableHeader']),
-            Paragraph('Фрукты', self.styles['TableHeader']),
-            Paragraph('Молока', self.styles['TableHeader']),
-            Paragraph('Злаки', self.styles['TableHeader']),
-            Paragraph('Время', self.styles['TableHeader']),
-        ]]
+        data = [list(_TABLE_HEADER_ROW)]
         
-        totals = {
-            'protein': 0, 'vegetables': 0, 'fats': 0,
-            'fruits': 0, 'dairy': 0, 'grains': 0
-        }
+        # Порции каждой записи в порядке NUTRIENT_KEYS
+        portions = list(map(_get_portions, entries))
         
-        for entry in entries:
+        for entry, entry_portions in zip(entries, portions):
             # Конвертируем время в московский часовой пояс
             time_str = entry.timestamp.astimezone(MOSCOW_TZ).strftime("%H:%M")
+            # Paragraph нужен только для названия приёма пищи, которое может переноситься.
+            # Числа и время передаются строками: шрифт для них задаётся в TableStyle.
             data.append([
                 Paragraph(entry.meal_time, self.styles['TableCell']),
-                Paragraph(str(entry.protein), self.styles['TableCell']),
-                Paragraph(str(entry.vegetables), self.styles['TableCell']),
-                Paragraph(str(entry.fats), self.styles['TableCell']),
-                Paragraph(str(entry.fruits), self.styles['TableCell']),
-                Paragraph(str(entry.dairy), self.styles['TableCell']),
-                Paragraph(str(entry.grains), self.styles['TableCell']),
-                Paragraph(time_str, self.styles['TableCell']),
+                *map(str, entry_portions),
+                time_str,
             ])
             
-            # Суммируем значения
-            totals['protein'] += entry.protein
-            totals['vegetables'] += entry.vegetables
-            totals['fats'] += entry.fats
-            totals['fruits'] += entry.fruits
-            totals['dairy'] += entry.dairy
-            totals['grains'] += entry.grains
+        # Суммируем значения по столбцам
+        column_sums = [sum(column) for column in zip(*portions)] or [0] * len(NUTRIENT_KEYS)
+        totals = dict(zip(NUTRIENT_KEYS, column_sums))
             
         # Добавляем строку с итогами
-        data.append([
-            Paragraph('Сумма', self.styles['TableHeader']),
-            Paragraph(str(totals['protein']), self.styles['TableHeader']),
-            Paragraph(str(totals['vegetables']), self.styles['TableHeader']),
-            Paragraph(str(totals['fats']), self.styles['TableHeader']),
-            Paragraph(str(totals['fruits']), self.styles['TableHeader']),
-            Paragraph(str(totals['dairy']), self.styles['TableHeader']),
-            Paragraph(str(totals['grains']), self.styles['TableHeader']),
-            ''
-        ])
+        data.append(['Сумма', *map(str, column_sums), ''])
         
         return data, totals
 
-    def _create_recommendations(self, totals: dict, user_norms: Dict[str, int]) -> List[Paragraph]:
+    def _create_recommendations(self, totals: dict) -> List[Paragraph]:
         """
         Создаёт список рекомендаций на основе анализа потребления.
         """
@@ -497,23 +670,54 @@ class PDFReportGenerator:
             
         return elements
 
-    def _add_image(self, meal_time: str, image_path: str, timestamp: datetime) -> List:
+    def _prepare_image(
+        self,
+        meal_time: str,
+        image_path: str,
+        timestamp: datetime
+    ) -> Optional[Tuple[str, Union[str, bytes], datetime, float, float]]:
+        """
+        Вычисляет размеры изображения для отчёта и при необходимости уменьшает его.
+        Возвращает путь к файлу или JPEG-байты уменьшенной копии.
+        Вызывается в пуле потоков, чтобы не блокировать цикл событий.
+        """
+        # Миниатюра создаётся при загрузке; оригинал уменьшается здесь только для старых фото без неё
+        thumb_path = thumbnail_path(image_path)
+        if os.path.exists(thumb_path):
+            image_path = thumb_path
+        try:
+            # Image.open читает только заголовок, пиксели декодируются лишь при уменьшении
+            with Image.open(image_path) as img:
+                img_width, img_height = img.size
+                aspect = img_height / float(img_width)
+                if img_width <= REPORT_IMAGE_WIDTH:
+                    # Небольшое изображение встраивается как есть
+                    image_data = image_path
+                else:
+                    img_io = BytesIO()
+                    _shrink_to_report_width(img).save(img_io, format='JPEG', quality=85)
+                    image_data = img_io.getvalue()
+        except Exception as e:
+            logger.error("Ошибка при чтении изображения %s: %s", image_path, e)
+            return None
+
+        img_width = REPORT_IMAGE_WIDTH
+        img_height = img_width * aspect
+        return meal_time, image_data, timestamp, img_width, img_height
+
+    def _add_image(
+        self,
+        meal_time: str,
+        image_data: Union[str, bytes],
+        timestamp: datetime,
+        img_width: float,
+        img_height: float
+    ) -> List:
         """
         Добавляет изображение в отчёт с подписью к нему.
         """
         elements = []
         try:
-            img = Image.open(image_path)
-            img_width, img_height = img.size
-            aspect = img_height / float(img_width)
-            img_width = 400  # Ширина изображения
-            img_height = img_width * aspect
-
-            img.thumbnail((img_width, img_height))
-            img_io = BytesIO()
-            img.save(img_io, format='PNG')
-            img_io.seek(0)
-
             # Форматирование времени
             time_str = timestamp.astimezone(MOSCOW_TZ).strftime("%H:%M")
 
@@ -522,111 +726,149 @@ class PDFReportGenerator:
             elements.append(Paragraph(caption_text, self.styles['PhotoCaption']))
             elements.append(Spacer(1, 5))
 
-            # Добавляем изображение
+            # Добавляем изображение: ReportLab встраивает JPEG как есть, без перекодирования
             from reportlab.platypus import Image as PlatypusImage
-            platypus_image = PlatypusImage(img_io, width=img_width, height=img_height)
+            if isinstance(image_data, bytes):
+                image_data = BytesIO(image_data)
+            platypus_image = PlatypusImage(image_data, width=img_width, height=img_height)
             elements.append(platypus_image)
             elements.append(PageBreak())
 
         except Exception as e:
-            logger.error(f"Ошибка при добавлении изображения: {e}")
+            logger.error("Ошибка при добавлении изображения: %s", e)
 
         return elements
 
     async def generate(self, entries: List[DiaryEntry]) -> Optional[str]:
         """
-        Генерирует PDF-отёт и возвращает путь к файлу.
+        Генерирует PDF-отчёт и возвращает путь к файлу.
+        Одновременные запросы одного и того же отчёта используют одну сборку.
         """
+        key = (self.user_id, self.date)
+        pending = _pending_reports.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        pending = asyncio.get_running_loop().create_future()
+        _pending_reports[key] = pending
         try:
-            os.makedirs(os.path.dirname(self.pdf_path), exist_ok=True)
-            
-            # Создаем шаблон документа с номерами страниц
-            doc = BaseDocTemplate(
-                self.pdf_path,
-                pagesize=A4,
-                rightMargin=20,
-                leftMargin=20,
-                topMargin=20,
-                bottomMargin=20
+            pdf_path = await self._generate(entries)
+            pending.set_result(pdf_path)
+            return pdf_path
+        finally:
+            if not pending.done():
+                pending.set_result(None)
+            del _pending_reports[key]
+
+    async def _generate(self, entries: List[DiaryEntry]) -> Optional[str]:
+        """
+        Подготавливает изображения в пуле потоков и собирает PDF в пуле процессов,
+        чтобы не блокировать обработку других обновлений.
+        """
+        try:
+            # Изображения обрабатываются параллельно в пуле потоков
+            images = [
+                (entry.meal_time, image_path, entry.timestamp)
+                for entry in entries
+                for image_path in entry.image_paths
+                if os.path.exists(image_path)
+            ]
+            prepared_images = await asyncio.gather(
+                *(asyncio.to_thread(self._prepare_image, *image) for image in images)
             )
 
-            frame = Frame(doc.leftMargin, doc.bottomMargin, doc.width, doc.height, id='normal')
-            template = PageTemplate(id='test', frames=frame, onPage=self._add_page_number)
-            doc.addPageTemplates([template])
+            executor = _get_report_executor()
+            return await asyncio.get_running_loop().run_in_executor(
+                executor,
+                _build_report,
+                self.user_id,
+                self.date,
+                self.user_norms,
+                entries,
+                prepared_images
+            )
 
-            elements = []
+        except BrokenProcessPool as e:
+            logger.error("Рабочий процесс сборки PDF завершился аварийно, пул будет создан заново: %s", e)
+            _discard_report_executor(executor)
+            return None
+        except Exception as e:
+            logger.error("Ошибка при создании PDF: %s", e)
+            return None
 
-            # Заголовок отчёта
-            title = Paragraph(f"Пищевой дневник за {self.date}", self.styles['CenterTitle'])
-            elements.append(title)
-            
-            # Отображение норм или вопросительных знаков
-            if self.nutrition_analyzer.recommendations:
-                norms_text = "Ваши ежедневные нормы потребления:\n"
-                norms_text += f"• Белки: {self.nutrition_analyzer.recommendations.protein_daily} порций\n"
-                norms_text += f"• Овощи: {self.nutrition_analyzer.recommendations.vegetables_daily} порций\n"
-                norms_text += f"• Жиры: {self.nutrition_analyzer.recommendations.fats_daily} порций\n"
-                norms_text += f"• Фрукты: {self.nutrition_analyzer.recommendations.fruits_daily} порций\n"
-                norms_text += f"• Молочные продкты: {self.nutrition_analyzer.recommendations.dairy_daily} порций\n"
-                norms_text += f"• Злаки: {self.nutrition_analyzer.recommendations.grains_daily} порций\n"
-            else:
-                norms_text = "Ваши ежедневные норм потребления:\n"
-                norms_text += "• Белки: ? порций\n"
-                norms_text += "• Овощи: ? порций\n"
-                norms_text += "• Жиры: ? порций\n"
-                norms_text += "• Фрукты: ? порций\n"
-                norms_text += "• Молочные родукты: ? порций\n"
-                norms_text += "• Злаки: ? порций\n"
-            
-            norms = Paragraph(norms_text, self.styles['Norms'])
-            elements.append(norms)
-            elements.append(Spacer(1, 10))
+    def _build_sync(self, entries: List[DiaryEntry], prepared_images: List[Optional[tuple]]) -> str:
+        """
+        Собирает PDF-документ и записывает его на диск.
+        Выполняется синхронно, вызывается из пула процессов.
+        """
+        # Документ собирается в памяти и записывается на диск одним вызовом
+        buffer = BytesIO()
+
+        # Создаем шаблон документа с номерами страниц
+        doc = BaseDocTemplate(
+            buffer,
+            pagesize=A4,
+            rightMargin=20,
+            leftMargin=20,
+            topMargin=20,
+            bottomMargin=20
+        )
 
-            # Создаём таблицу
-            table_data, totals = self._create_table_data(entries)
-            
-            # Рассчитываем общую ширину страницы
-            page_width = A4[0] - doc.leftMargin - doc.rightMargin
+        frame = Frame(doc.leftMargin, doc.bottomMargin, doc.width, doc.height, id='normal')
+        template = PageTemplate(id='test', frames=frame, onPage=self._add_page_number)
+        doc.addPageTemplates([template])
 
-            # Определяем ширины столбцов пропорционально
-            col_ratios = [1.5, 1, 1, 1, 1, 1.2, 1, 1.2]
-            total_ratio = sum(col_ratios)
-            col_widths = [(ratio / total_ratio) * page_width for ratio in col_ratios]
+        elements = []
 
-            # Устанавливаем минимальную ширину столбцов
-            min_col_width = 100  # Минимальная ширина столбца
-            col_widths = [max(width, min_col_width) for width in col_widths]
-            
-            table = Table(table_data, colWidths=col_widths)
-            
-            # Добавляем стиль к таблице
-            table.setStyle(self._create_table_style())
+        # Заголовок отчёта
+        title = Paragraph(f"Пищевой дневник за {self.date}", self.styles['CenterTitle'])
+        elements.append(title)
+        
+        # Отображение норм или вопросительных знаков
+        if self.nutrition_analyzer:
+            norms_text = format_norms_text(*self.nutrition_analyzer.recommendations.as_tuple())
+        else:
+            norms_text = EMPTY_NORMS_TEXT
+        
+        norms = Paragraph(norms_text, self.styles['Norms'])
+        elements.append(norms)
+        elements.append(Spacer(1, 10))
+
+        # Создаём таблицу
+        table_data, totals = self._create_table_data(entries)
+        
+        # Рассчитываем общую ширину страницы
+        page_width = A4[0] - doc.leftMargin - doc.rightMargin
 
-            elements.append(table)
-            elements.append(Spacer(1, 20))
+        # Определяем ширины столбцов пропорционально
+        col_widths = compute_col_widths(page_width)
+        
+        table = Table(table_data, colWidths=col_widths)
+        
+        # Добавляем стиль к таблице
+        table.setStyle(self._create_table_style())
 
-            # Добавляем разделительную линию
-            elements.append(HRFlowable(width="100%", thickness=1, color=colors.HexColor('#BDC3C7')))
-            elements.append(Spacer(1, 10))
+        elements.append(table)
+        elements.append(Spacer(1, 20))
 
-            # Добавляем рекомендации
-            recommendations_elements = self._create_recommendations(totals, self.nutrition_analyzer.recommendations.__dict__ if self.nutrition_analyzer.recommendations else None)
-            elements.extend(recommendations_elements)
+        # Добавляем разделительную линию
+        elements.append(HRFlowable(width="100%", thickness=1, color=colors.HexColor('#BDC3C7')))
+        elements.append(Spacer(1, 10))
 
-            # Добавляем фотографии (по одной на страницу)
-            for entry in entries:
-                if entry.image_paths:
-                    for image_path in entry.image_paths:
-                        if os.path.exists(image_path):
-                            elements.extend(self._add_image(entry.meal_time, image_path, entry.timestamp))
+        # Добавляем рекомендации, если пользователь задал нормы
+        if self.nutrition_analyzer:
+            elements.extend(self._create_recommendations(totals))
 
-            doc.build(elements)
-            logger.info(f"PDF отчёт успешно создан: {self.pdf_path}")
-            return self.pdf_path
+        # Добавляем фотографии (по одной на страницу)
+        for prepared_image in prepared_images:
+            if prepared_image:
+                elements.extend(self._add_image(*prepared_image))
 
-        except Exception as e:
-            logger.error(f"Ошибка при создании PDF: {e}")
-            return None
+        doc.build(elements)
+        with open(self.pdf_path, 'wb') as f:
+            f.write(buffer.getbuffer())
+        logger.info("PDF отчёт успешно создан: %s", self.pdf_path)
+        return self.pdf_path
 
     def _add_page_number(self, canvas, doc):
         """
@@ -638,64 +880,64 @@ class PDFReportGenerator:
         canvas.drawCentredString(A4[0] / 2, 15 * mm, text)
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Логирует исключения, возникшие в обработчиках."""
-    logger.error(msg="Исключение во время обработки обновления:", exc_info=context.error)
+    """
+    Обрабатывает исключения, возникшие в обработчиках.
+    При ограничении частоты и сетевых сбоях делает паузу вместо падения, остальные ошибки логирует.
+    """
+    error = context.error
+    if isinstance(error, RetryAfter):
+        logger.warning("Превышен лимит Telegram, пауза %s с.", error.retry_after)
+        await asyncio.sleep(error.retry_after)
+        return
+    # TimedOut — подкласс NetworkError
+    if isinstance(error, NetworkError):
+        logger.warning("Сетевая ошибка при обращении к Telegram: %s", error)
+        await asyncio.sleep(1)
+        return
+    logger.error(msg="Исключение во время обработки обновления:", exc_info=error)
 
 async def view_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("Функция просмотра отчёта в разработке. Пожалуйста, попробуйте позже.")
 
+def _fmt_date(date: str) -> str:
+    """
+    Переводит дату из формата базы данных YYYY-MM-DD в DD.MM.YYYY.
+    Формат в базе фиксирован, поэтому достаточно срезов строки без strptime.
+    """
+    return f"{date[8:10]}.{date[5:7]}.{date[0:4]}"
+
 async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает статистику питания за последнюю неделю."""
     user_id = update.effective_user.id
     end_date = datetime.now(MOSCOW_TZ)
     start_date = end_date - timedelta(days=7)
 
-    # Получаем записи за период
-    entries = get_entries_for_period(
+    # Получаем суммы по дням за период
+    daily_totals = await asyncio.to_thread(
+        get_daily_totals_for_period,
         user_id,
         start_date.strftime("%Y-%m-%d"),
         end_date.strftime("%Y-%m-%d")
     )
 
-    if not entries:
+    if not daily_totals:
         await update.message.reply_text("📊 Нет данных за последнюю неделю.")
         return
 
-    # Анализируем данные и формируем статистику
-    daily_totals = {}
-    for entry in entries:
-        date = entry[0]
-        protein = entry[2] or 0
-        vegetables = entry[3] or 0
-        fats = entry[4] or 0
-        fruits = entry[5] or 0
-        dairy = entry[6] or 0
-        grains = entry[7] or 0
-
-        if date not in daily_totals:
-            daily_totals[date] = {
-                'protein': 0, 'vegetables': 0, 'fats': 0,
-                'fruits': 0, 'dairy': 0, 'grains': 0
-            }
-
-        daily_totals[date]['protein'] += protein
-        daily_totals[date]['vegetables'] += vegetables
-        daily_totals[date]['fats'] += fats
-        daily_totals[date]['fruits'] += fruits
-        daily_totals[date]['dairy'] += dairy
-        daily_totals[date]['grains'] += grains
-
     # Формируем сообщение со статистикой
-    message = "📊 *Статистика питания за последнюю неделю:*\n"
-    for date, totals in daily_totals.items():
-        formatted_date = datetime.strptime(date, "%Y-%m-%d").strftime("%d.%m.%Y")
-        message += f"\n📅 *{formatted_date}*\n"
-        message += f"🍗 Белки: {totals['protein']} порций\n"
-        message += f"🥦 Овощи: {totals['vegetables']} порций\n"
-        message += f"🥑 Жиры: {totals['fats']} порций\n"
-        message += f"🍎 Фрукты: {totals['fruits']} порций\n"
-        message += f"🥛 Молочка: {totals['dairy']} порций\n"
-        message += f"🍞 Злаки: {totals['grains']} порций\n"
+    lines = ["📊 *Статистика питания за последнюю неделю:*"]
+    for date, protein, vegetables, fats, fruits, dairy, grains in daily_totals:
+        lines.extend((
+            "",
+            f"📅 *{_fmt_date(date)}*",
+            f"🍗 Белки: {protein} порций",
+            f"🥦 Овощи: {vegetables} порций",
+            f"🥑 Жиры: {fats} порций",
+            f"🍎 Фрукты: {fruits} порций",
+            f"🥛 Молочка: {dairy} порций",
+            f"🍞 Злаки: {grains} порций",
+        ))
+    message = "\n".join(lines)
 
     await update.message.reply_text(message, parse_mode='Markdown')
 
@@ -707,164 +949,164 @@ async def set_norms_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         "Введите вашу ежедневную норму *Белков* (в порциях):",
         parse_mode='Markdown'
     )
+    context.user_data['_norms_step'] = 0
+    # Нормы собираются сразу в итоговый словарь, который в конце сохраняется целиком
+    context.user_data['_norms_draft'] = {}
     return SET_PROTEIN
 
-async def set_protein(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        protein = int(update.message.text)
-        context.user_data['protein_daily'] = protein
-        await update.message.reply_text("Введите вашу ежедневную норму *Овощей* (в порциях):")
-        return SET_VEGETABLES
-    except ValueError:
-        await update.message.reply_text("Пожалуйста, введите целое число для *Белков* (в порциях):", parse_mode='Markdown')
-        return SET_PROTEIN
-
-async def set_vegetables(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        vegetables = int(update.message.text)
-        context.user_data['vegetables_daily'] = vegetables
-        await update.message.reply_text("Введите вашу ежедневную норму *Жиров* (в порциях):")
-        return SET_FATS
-    except ValueError:
-        await update.message.reply_text("Пожалуйста, введите целое число для *Овощей* (в порциях):", parse_mode='Markdown')
-        return SET_VEGETABLES
-
-async def set_fats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        fats = int(update.message.text)
-        context.user_data['fats_daily'] = fats
-        await update.message.reply_text("Введите вашу ежедневную норму *Фруктов* (в порциях):")
-        return SET_FRUITS
-    except ValueError:
-        await update.message.reply_text("Пожалуйста, введите целое число для *Жиров* (в порциях):", parse_mode='Markdown')
-        return SET_FATS
-
-async def set_fruits(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        fruits = int(update.message.text)
-        context.user_data['fruits_daily'] = fruits
-        await update.message.reply_text("Введите вашу ежедневную норму *Молочных продуктов* (в порциях):")
-        return SET_DAIRY
-    except ValueError:
-        await update.message.reply_text("Пожалуйста, введите целое число для *Фруктов* (в порциях):", parse_mode='Markdown')
-        return SET_FRUITS
-
-async def set_dairy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        dairy = int(update.message.text)
-        context.user_data['dairy_daily'] = dairy
-        await update.message.reply_text("Введите вашу ежедневную норму *Злаков* (в порциях):")
-        return SET_GRAINS
-    except ValueError:
-        await update.message.reply_text("Пожалуйста, введите целое число для *Молочных продуктов* (в порциях):", parse_mode='Markdown')
-        return SET_DAIRY
-
-async def set_grains(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    try:
-        grains = int(update.message.text)
-        context.user_data['grains_daily'] = grains
-
-        # Сохраняем пользовательские нормы
-        user_norms = {
-            'protein_daily': context.user_data.get('protein_daily'),
-            'vegetables_daily': context.user_data.get('vegetables_daily'),
-            'fats_daily': context.user_data.get('fats_daily'),
-            'fruits_daily': context.user_data.get('fruits_daily'),
-            'dairy_daily': context.user_data.get('dairy_daily'),
-            'grains_daily': context.user_data.get('grains_daily'),
-        }
+# Шаги диалога установки норм: (состояние, ключ в user_data, название пищевой группы)
+NORMS_STEPS = [
+    (SET_PROTEIN, 'protein_daily', 'Белков'),
+    (SET_VEGETABLES, 'vegetables_daily', 'Овощей'),
+    (SET_FATS, 'fats_daily', 'Жиров'),
+    (SET_FRUITS, 'fruits_daily', 'Фруктов'),
+    (SET_DAIRY, 'dairy_daily', 'Молочных продуктов'),
+    (SET_GRAINS, 'grains_daily', 'Злаков'),
+]
+
+# Тексты подсказок диалога установки норм по состояниям
+NORMS_PROMPTS = {
+    state: f"Введите вашу ежедневную норму *{name}* (в порциях):"
+    for state, _, name in NORMS_STEPS
+}
+NORMS_RETRY_PROMPTS = {
+    state: f"Пожалуйста, введите целое число для *{name}* (в порциях):"
+    for state, _, name in NORMS_STEPS
+}
+
+async def set_norm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обрабатывает ввод очередной нормы в диалоге /set_norms."""
+    step = context.user_data.setdefault('_norms_step', 0)
+    state, field, _ = NORMS_STEPS[step]
+    value = _parse_portions(update.message.text)
+    if value is None:
+        await update.message.reply_text(NORMS_RETRY_PROMPTS[state], parse_mode='Markdown')
+        return state
+
+    context.user_data.setdefault('_norms_draft', {})[field] = value
+    step += 1
+
+    if step == len(NORMS_STEPS):
+        context.user_data.pop('_norms_step', None)
+        # Черновик уже в итоговом виде; до конца диалога он не виден как user_norms,
+        # чтобы незаполненные нормы не попали в отчёты
+        user_norms = context.user_data.pop('_norms_draft')
+        # user_data сохраняется PicklePersistence, поэтому нормы переживают перезапуск бота
         context.user_data['user_norms'] = user_norms
-
         await update.message.reply_text("✅ Ваши ежедневные нормы успешно сохранены!")
         return ConversationHandler.END
-    except ValueError:
-        await update.message.reply_text("Пожалуйста, введите целое число для *Злаков* (в порциях):", parse_mode='Markdown')
-        return SET_GRAINS
+
+    context.user_data['_norms_step'] = step
+    next_state = NORMS_STEPS[step][0]
+    await update.message.reply_text(NORMS_PROMPTS[next_state], parse_mode='Markdown')
+    return next_state
 
 async def set_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Настраивает напоминания о приёмах пищи."""
     chat_id = update.effective_chat.id
 
-    # Удаляем предыдущие задания, если они есть
-    if 'reminder_jobs' in context.chat_data:
-        for job in context.chat_data['reminder_jobs']:
-            job.schedule_removal()
-        context.chat_data['reminder_jobs'] = []
-
-    # Настраиваем напоминания (пример фиксированных времён)
-    times = ['08:00', '12:00', '18:00']  # Замените на нужные времена
-
-    reminder_jobs = []
-    for time_str in times:
-        hour, minute = map(int, time_str.split(':'))
-        job = context.job_queue.run_daily(
-            send_reminder,
-            time=datetime.time(hour=hour, minute=minute, tzinfo=MOSCOW_TZ),
-            chat_id=chat_id,
-            name=f"reminder_{time_str}_{chat_id}"
-        )
-        reminder_jobs.append(job)
-
-    context.chat_data['reminder_jobs'] = reminder_jobs
+    # Рассылку выполняют общие задания в main(), здесь достаточно сохранить подписку чата
+    times = [f"{reminder_time:%H:%M}" for reminder_time in REMINDER_TIMES]
+    await asyncio.to_thread(save_reminders, chat_id, times)
 
     await update.message.reply_text("⏰ Напоминания успешно настроены!")
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет напоминание о приёме пищи."""
-    await context.bot.send_message(
-        chat_id=context.job.chat_id,
-        text="🍽️ Пора записать свой приём пищи!"
+# Рассылка напоминаний ограничивается 25 сообщениями в секунду и 25 одновременными запросами,
+# чтобы не упираться в глобальный лимит Telegram в 30 сообщений в секунду
+_SEND_SEM = asyncio.Semaphore(25)
+_SEND_LIMITER = AsyncLimiter(25, 1)
+
+async def send_reminder(bot, chat_id: int):
+    """Отправляет напоминание о приёме пищи в чат."""
+    async with _SEND_SEM, _SEND_LIMITER:
+        try:
+            await bot.send_message(
+                chat_id=chat_id,
+                text="🍽️ Пора записать свой приём пищи!"
+            )
+        except RetryAfter as e:
+            # Telegram просит подождать: повторяем отправку один раз после паузы
+            logger.warning("Превышен лимит Telegram, повтор через %s с.", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+            await bot.send_message(
+                chat_id=chat_id,
+                text="🍽️ Пора записать свой приём пищи!"
+            )
+
+async def broadcast_reminder(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Рассылает напоминание всем чатам, подписанным на время срабатывания задания.
+    Время напоминания передаётся в context.job.data в формате HH:MM.
+    """
+    chat_ids = await asyncio.to_thread(get_reminder_chat_ids, context.job.data)
+    results = await asyncio.gather(
+        *(send_reminder(context.bot, chat_id) for chat_id in chat_ids),
+        return_exceptions=True
     )
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            logger.warning("Не удалось отправить напоминание в чат %s: %s", chat_id, result)
+    logger.info("Напоминание %s отправлено в %s чатов", context.job.data, len(chat_ids))
 
 def main():
     """Запускает бота и инициализирует обработчики."""
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
-
-    # Обработчики команд
-    application.add_handler(MessageHandler(filters.Regex('^/start$'), start))
-    application.add_handler(MessageHandler(filters.Regex('^/add$'), add_entry_start))
-    application.add_handler(MessageHandler(filters.Regex('^/view$'), view_report))
-    application.add_handler(MessageHandler(filters.Regex('^/stats$'), show_stats))
-    application.add_handler(MessageHandler(filters.Regex('^/set_norms$'), set_norms_start))
-    application.add_handler(MessageHandler(filters.Regex('^/reminders$'), set_reminders))
-    application.add_handler(MessageHandler(filters.Regex('^/cancel$'), cancel))
+    # uvloop ускоряет цикл событий; на Windows он недоступен, там остаётся стандартный asyncio
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop не установлен, используется стандартный цикл событий asyncio")
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Исходящие запросы и получение обновлений используют разные пулы соединений,
+    # чтобы long-poll getUpdates не занимал соединения, нужные для ответов и напоминаний
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        http_version="2",
+        connect_timeout=5,
+        read_timeout=10,
+    )
+    get_updates_request = HTTPXRequest(connection_pool_size=16)
+
+    # Состояние диалогов и user_data сохраняются на диск, чтобы перезапуск
+    # бота не сбрасывал пользователя посреди /add или /set_norms
+    persistence = PicklePersistence(filepath=STATE_FILE, update_interval=30)
+
+    # Обновления обрабатываются по одному: ConversationHandler на это рассчитан.
+    # Работа с SQLite и сборка PDF и так вынесены из цикла событий в пулы потоков и процессов.
+    # Исходящие запросы ограничиваются по лимитам Telegram
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(AIORateLimiter())
+        .persistence(persistence)
+        .post_shutdown(_shutdown_report_executor)
+        .build()
+    )
 
     # Создание экземпляра NutrientInputHandler
     nutrient_input_handler = NutrientInputHandler()
+    # Все состояния ввода порций обслуживает один и тот же обработчик
+    nutrient_message_handler = MessageHandler(TEXT_NOCMD, nutrient_input_handler.handle_input)
 
     # Определение состояний для ConversationHandler
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('add', add_entry_start)],
         states={
             ConversationState.CHOOSE_MEAL.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, choose_meal)
+                MessageHandler(TEXT_NOCMD, choose_meal)
             ],
             ConversationState.UPLOAD_PHOTO.value: [
-                MessageHandler(
-                    filters.PHOTO | filters.Regex('^/done$') | (filters.TEXT & ~filters.COMMAND),
-                    upload_photos
-                )
-            ],
-            ConversationState.ENTER_PROTEIN.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, nutrient_input_handler.handle_input)
-            ],
-            ConversationState.ENTER_VEGETABLES.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, nutrient_input_handler.handle_input)
-            ],
-            ConversationState.ENTER_FATS.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, nutrient_input_handler.handle_input)
-            ],
-            ConversationState.ENTER_FRUITS.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, nutrient_input_handler.handle_input)
-            ],
-            ConversationState.ENTER_DAIRY.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, nutrient_input_handler.handle_input)
-            ],
-            ConversationState.ENTER_GRAINS.value: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, nutrient_input_handler.handle_input)
+                CommandHandler('done', finish_upload),
+                MessageHandler(UPLOAD_FILTER, upload_photos)
             ],
+            **{state.value: [nutrient_message_handler] for state in nutrient_input_handler.nutrients},
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='add_entry',
+        persistent=True,
     )
     application.add_handler(conv_handler)
 
@@ -872,22 +1114,48 @@ def main():
     set_norms_conv_handler = ConversationHandler(
         entry_points=[CommandHandler('set_norms', set_norms_start)],
         states={
-            SET_PROTEIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_protein)],
-            SET_VEGETABLES: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_vegetables)],
-            SET_FATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_fats)],
-            SET_FRUITS: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_fruits)],
-            SET_DAIRY: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_dairy)],
-            SET_GRAINS: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_grains)],
+            state: [MessageHandler(TEXT_NOCMD, set_norm)]
+            for state, _, _ in NORMS_STEPS
         },
         fallbacks=[CommandHandler('cancel', cancel)],
+        name='set_norms',
+        persistent=True,
     )
     application.add_handler(set_norms_conv_handler)
 
+    # Обработчики команд. Регистрируются после диалогов, чтобы /cancel
+    # внутри диалога попадал в его fallbacks и завершал его.
+    # /add и /set_norms обрабатываются точками входа диалогов.
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('view', view_report))
+    application.add_handler(CommandHandler('stats', show_stats))
+    application.add_handler(CommandHandler('reminders', set_reminders))
+    application.add_handler(CommandHandler('cancel', cancel))
+
+    # Одно задание на каждое время напоминания; получатели берутся из базы при срабатывании
+    for reminder_time in REMINDER_TIMES:
+        application.job_queue.run_daily(
+            broadcast_reminder,
+            time=reminder_time,
+            data=f"{reminder_time:%H:%M}",
+            name=f"reminder_{reminder_time:%H:%M}"
+        )
+
     # Добавьте обработчик ошибок
     application.add_error_handler(error_handler)
 
-    # Запуск бота
-    application.run_polling()
+    # Запуск бота: в продакшене Telegram сам присылает обновления на webhook,
+    # для локальной разработки используется polling
+    if DEV or not WEBHOOK_HOST:
+        application.run_polling()
+    else:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"https://{WEBHOOK_HOST}/{TELEGRAM_BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+        )
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
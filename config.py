@@ -9,6 +9,16 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("Не задан TELEGRAM_BOT_TOKEN в переменных окружения.")
 
+# Уровень логирования: в продакшене INFO, для отладки можно задать LOG_LEVEL=DEBUG
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Настройки webhook. Если WEBHOOK_HOST не задан или задан DEV, бот работает через polling.
+# DEV=0 или DEV=false режим разработки не включают
+DEV = os.getenv('DEV', '').lower() in ('1', 'true', 'yes')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
 # Определение пути к шрифту в зависимости от операционной системы
 system = platform.system()
 if system == 'Windows':
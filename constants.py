@@ -20,6 +20,9 @@ NUTRIENT_LIMITS = {
     'grains': (0, 10)
 }
 
+# Ключи пищевых групп в порядке столбцов таблицы и базы данных
+NUTRIENT_KEYS = tuple(NUTRIENT_LIMITS)
+
 # Иконки для нутриентов
 NUTRIENT_EMOJI = {
     'protein': '🍗',
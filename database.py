@@ -1,29 +1,132 @@
 import sqlite3
 import os
+import threading
+from contextlib import contextmanager
 from typing import List
-from datetime import datetime
-import pytz
+from datetime import date as date_type, datetime
+from zoneinfo import ZoneInfo
 import logging
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_NAME = os.path.join(BASE_DIR, 'food_diary.db')
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+MOSCOW_TZ = ZoneInfo('Europe/Moscow')
 logger = logging.getLogger(__name__)
 
+# Соединение с базой данных открывается по одному на поток: обращения к базе выполняются
+# через asyncio.to_thread, и при WAL-журнале потоки читают параллельно, не ожидая друг друга.
+_local = threading.local()
+
+def _get_connection() -> sqlite3.Connection:
+    """
+    Возвращает соединение с базой данных текущего потока, открывая его при первом вызове.
+    Включает WAL-журнал, чтобы чтение не блокировалось записью.
+    Транзакциями управляет _transaction(), поэтому соединение работает в режиме autocommit.
+    """
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        # Разобранные запросы переиспользуются из кэша соединения
+        connection = sqlite3.connect(DB_NAME, isolation_level=None, cached_statements=256)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        # Временные таблицы и индексы держим в памяти, файл базы читаем через mmap (до 256 МБ)
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA mmap_size=268435456")
+        # Внешние ключи в SQLite по умолчанию не проверяются
+        connection.execute("PRAGMA foreign_keys=ON")
+        _local.connection = connection
+    return connection
+
+def _to_day(date: str) -> int:
+    """Переводит дату YYYY-MM-DD в номер дня, под которым она хранится в meals.date."""
+    return date_type.fromisoformat(date).toordinal()
+
+def _from_day(day: int) -> str:
+    """Переводит номер дня из meals.date обратно в дату YYYY-MM-DD."""
+    return date_type.fromordinal(day).isoformat()
+
+@contextmanager
+def _transaction():
+    """
+    Выполняет блок в транзакции записи. BEGIN IMMEDIATE сразу берёт блокировку записи,
+    поэтому параллельные записи ждут друг друга, а не падают с ошибкой при фиксации.
+    """
+    connection = _get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+        # COMMIT тоже может упасть (например, на отложенной проверке внешних ключей),
+        # тогда транзакцию нужно откатить, а не оставлять открытой
+        connection.execute("COMMIT")
+    except BaseException:
+        # При некоторых ошибках (SQLITE_FULL, IOERR) SQLite откатывает транзакцию сам,
+        # и повторный ROLLBACK скрыл бы исходную ошибку
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
+
+def _migrate_meal_dates() -> None:
+    """
+    Переносит meals из старой схемы, где дата хранилась строкой YYYY-MM-DD, на целочисленные
+    номера дней (date.toordinal()). Тип столбца в SQLite не меняется через ALTER, поэтому
+    таблица пересоздаётся; id записей сохраняются, и ссылки из meal_photos остаются верными.
+    """
+    connection = _get_connection()
+    columns = {name: col_type for _, name, col_type, *_ in connection.execute("PRAGMA table_info(meals)")}
+    if columns.get('date', 'INTEGER').upper() == 'INTEGER':
+        return
+    logger.info("Перевод meals.date из TEXT в INTEGER")
+    # DROP TABLE meals нарушил бы ссылки из meal_photos, поэтому на время пересоздания
+    # проверка внешних ключей отключается (вне транзакции, иначе PRAGMA не действует)
+    connection.execute("PRAGMA foreign_keys=OFF")
+    try:
+        with _transaction() as conn:
+            _rebuild_meals(conn.cursor())
+    finally:
+        connection.execute("PRAGMA foreign_keys=ON")
+
+def _rebuild_meals(cursor: sqlite3.Cursor) -> None:
+    """Пересоздаёт meals с целочисленной датой, перенося записи с теми же id."""
+    cursor.execute('''
+        CREATE TABLE meals_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date INTEGER NOT NULL,
+            meal_time TEXT NOT NULL,
+            protein INTEGER,
+            vegetables INTEGER,
+            fats INTEGER,
+            fruits INTEGER,
+            dairy INTEGER,
+            grains INTEGER,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # julianday('0001-01-01') = 1721425.5, а date(1, 1, 1).toordinal() = 1
+    cursor.execute('''
+        INSERT INTO meals_new (id, user_id, date, meal_time, protein, vegetables, fats, fruits, dairy, grains, timestamp)
+        SELECT id, user_id, CAST(julianday(date) - 1721424.5 AS INTEGER), meal_time,
+               protein, vegetables, fats, fruits, dairy, grains, timestamp
+        FROM meals
+    ''')
+    cursor.execute("DROP TABLE meals")
+    cursor.execute("ALTER TABLE meals_new RENAME TO meals")
+
 def init_db():
     """
     Инициализирует базу данных, создавая необходимые таблицы, если они не существуют.
     """
     try:
         db_path = os.path.join(os.getcwd(), DB_NAME)
-        logger.info(f"Инициализация базы данных по пути: {db_path}")
-        with sqlite3.connect(db_path) as conn:
+        logger.info("Инициализация базы данных по пути: %s", db_path)
+        # Старая таблица переносится до создания индексов, чтобы они строились уже по новой
+        _migrate_meal_dates()
+        with _transaction() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS meals (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     user_id INTEGER NOT NULL,
-                    date TEXT NOT NULL,
+                    date INTEGER NOT NULL,
                     meal_time TEXT NOT NULL,
                     protein INTEGER,
                     vegetables INTEGER,
@@ -42,9 +145,30 @@ def init_db():
                     FOREIGN KEY(meal_id) REFERENCES meals(id)
                 )
             ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS reminders (
+                    chat_id INTEGER NOT NULL,
+                    time TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, time)
+                )
+            ''')
+            # Индексы под выборки записей за дату/период (заодно дают сортировку по времени),
+            # фотографий по записи и подписчиков на время напоминания
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_meals_user_date_ts
+                ON meals (user_id, date, timestamp)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_meal_photos_meal
+                ON meal_photos (meal_id)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_reminders_time
+                ON reminders (time)
+            ''')
             logger.info("Таблицы базы данных успешно созданы.")
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при инициализации базы данных: {e}")
+        logger.error("Ошибка при инициализации базы данных: %s", e)
 
 def add_entry(user_id, date, meal_time, protein, vegetables, fats, fruits, dairy, grains, image_paths, timestamp):
     """
@@ -63,20 +187,20 @@ def add_entry(user_id, date, meal_time, protein, vegetables, fats, fruits, dairy
         image_paths (list): Список путей к фотографиям блюд.
         timestamp (str): Время создания записи.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO meals (user_id, date, meal_time, protein, vegetables, fats, fruits, dairy, grains, timestamp)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, date, meal_time, protein, vegetables, fats, fruits, dairy, grains, timestamp))
-    meal_id = cursor.lastrowid
-    for image_path in image_paths:
+    with _transaction() as conn:
+        cursor = conn.cursor()
         cursor.execute('''
+            INSERT INTO meals (user_id, date, meal_time, protein, vegetables, fats, fruits, dairy, grains, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            RETURNING id
+        ''', (user_id, _to_day(date), meal_time, protein, vegetables, fats, fruits, dairy, grains, timestamp))
+        # id новой записи возвращается тем же запросом (SQLite 3.35+)
+        meal_id = cursor.fetchone()[0]
+        # Фотографии вставляются одним подготовленным запросом в той же транзакции
+        cursor.executemany('''
             INSERT INTO meal_photos (meal_id, image_path)
             VALUES (?, ?)
-        ''', (meal_id, image_path))
-    conn.commit()
-    conn.close()
+        ''', [(meal_id, image_path) for image_path in image_paths])
 
 def get_entries(user_id, date):
     """
@@ -89,32 +213,60 @@ def get_entries(user_id, date):
     Returns:
         list: Список записей с прикреплёнными фотографиями.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    # Фотографии собираются тем же запросом: пути склеиваются через символ-разделитель
+    # char(31), которого не бывает в путях. Вложенный SELECT сохраняет порядок загрузки фото.
+    cursor = _get_connection().cursor()
     cursor.execute('''
-        SELECT meals.id, meal_time, protein, vegetables, fats, fruits, dairy, grains, timestamp
+        SELECT meal_time, protein, vegetables, fats, fruits, dairy, grains,
+               (
+                   SELECT group_concat(image_path, char(31))
+                   FROM (
+                       SELECT image_path
+                       FROM meal_photos
+                       WHERE meal_id = meals.id
+                       ORDER BY id
+                   )
+               ),
+               timestamp
         FROM meals
         WHERE user_id = ? AND date = ?
         ORDER BY timestamp ASC
-    ''', (user_id, date))
-    meal_rows = cursor.fetchall()
+    ''', (user_id, _to_day(date)))
+    rows = cursor.fetchall()
 
     entries = []
-    for meal_row in meal_rows:
-        meal_id = meal_row[0]
-        cursor.execute('''
-            SELECT image_path
-            FROM meal_photos
-            WHERE meal_id = ?
-        ''', (meal_id,))
-        photos = [row[0] for row in cursor.fetchall()]
-        timestamp = datetime.strptime(meal_row[-1], '%Y-%m-%d %H:%M:%S')
-        timestamp = MOSCOW_TZ.localize(timestamp)
-        entries.append(meal_row[1:-1] + (photos, timestamp))
-
-    conn.close()
+    for row in rows:
+        photos = row[-2].split('\x1f') if row[-2] else []
+        # Время хранится как 'YYYY-MM-DD HH:MM:SS', это ISO-формат: fromisoformat разбирает его на C
+        timestamp = datetime.fromisoformat(row[-1]).replace(tzinfo=MOSCOW_TZ)
+        entries.append(row[:-2] + (photos, timestamp))
+
     return entries
 
+# Запросы за период хранятся константами: кэш подготовленных выражений
+# соединения находит их по тексту запроса. Даты в meals хранятся номерами дней,
+# поэтому BETWEEN сравнивает целые числа, а не строки
+_PERIOD_ENTRIES_SQL = '''
+    SELECT date, meal_time, protein, vegetables, fats, fruits, dairy, grains, timestamp
+    FROM meals
+    WHERE user_id = ? AND date BETWEEN ? AND ?
+    ORDER BY date ASC, timestamp ASC
+'''
+
+_PERIOD_TOTALS_SQL = '''
+    SELECT date,
+           COALESCE(SUM(protein), 0),
+           COALESCE(SUM(vegetables), 0),
+           COALESCE(SUM(fats), 0),
+           COALESCE(SUM(fruits), 0),
+           COALESCE(SUM(dairy), 0),
+           COALESCE(SUM(grains), 0)
+    FROM meals
+    WHERE user_id = ? AND date BETWEEN ? AND ?
+    GROUP BY date
+    ORDER BY date ASC
+'''
+
 def get_entries_for_period(user_id: int, start_date: str, end_date: str) -> List[tuple]:
     """
     Получает записи за указанный период.
@@ -127,14 +279,55 @@ def get_entries_for_period(user_id: int, start_date: str, end_date: str) -> List
     Returns:
         List[tuple]: Список записей за период.
     """
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT date, meal_time, protein, vegetables, fats, fruits, dairy, grains, timestamp
-        FROM meals
-        WHERE user_id = ? AND date BETWEEN ? AND ?
-        ORDER BY date ASC, timestamp ASC
-    ''', (user_id, start_date, end_date))
+    cursor = _get_connection().cursor()
+    cursor.execute(_PERIOD_ENTRIES_SQL, (user_id, _to_day(start_date), _to_day(end_date)))
+    rows = cursor.fetchall()
+    return [(_from_day(row[0]),) + row[1:] for row in rows]
+
+def get_daily_totals_for_period(user_id: int, start_date: str, end_date: str) -> List[tuple]:
+    """
+    Получает суммарное потребление по дням за указанный период.
+    Суммирование выполняется на стороне SQLite.
+
+    Args:
+        user_id (int): Идентификатор пользователя.
+        start_date (str): Начальная дата в формате YYYY-MM-DD.
+        end_date (str): Конечная дата в формате YYYY-MM-DD.
+
+    Returns:
+        List[tuple]: Список кортежей (date, protein, vegetables, fats, fruits, dairy, grains).
+    """
+    cursor = _get_connection().cursor()
+    cursor.execute(_PERIOD_TOTALS_SQL, (user_id, _to_day(start_date), _to_day(end_date)))
+    rows = cursor.fetchall()
+    return [(_from_day(row[0]),) + row[1:] for row in rows]
+
+def save_reminders(chat_id: int, times: List[str]) -> None:
+    """
+    Сохраняет времена напоминаний для чата, заменяя ранее сохранённые.
+
+    Args:
+        chat_id (int): Идентификатор чата.
+        times (List[str]): Времена напоминаний в формате HH:MM.
+    """
+    with _transaction() as conn:
+        conn.execute('DELETE FROM reminders WHERE chat_id = ?', (chat_id,))
+        conn.executemany(
+            'INSERT INTO reminders (chat_id, time) VALUES (?, ?)',
+            [(chat_id, time_str) for time_str in times]
+        )
+
+def get_reminder_chat_ids(time_str: str) -> List[int]:
+    """
+    Получает чаты, подписанные на напоминание в указанное время.
+
+    Args:
+        time_str (str): Время напоминания в формате HH:MM.
+
+    Returns:
+        List[int]: Идентификаторы чатов.
+    """
+    cursor = _get_connection().cursor()
+    cursor.execute('SELECT chat_id FROM reminders WHERE time = ?', (time_str,))
     rows = cursor.fetchall()
-    conn.close()
-    return rows
+    return [chat_id for (chat_id,) in rows]
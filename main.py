@@ -1,5 +1,6 @@
 import logging
 
+from config import LOG_LEVEL
 from bot import main as bot_main
 from database import init_db
 
@@ -7,7 +8,7 @@ def setup_logging():
     """Настраивает конфигурацию логирования"""
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
+        level=LOG_LEVEL
     )
 
 def main():
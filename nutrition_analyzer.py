@@ -1,7 +1,8 @@
 from dataclasses import dataclass
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
-@dataclass
+# slots убирают __dict__ у экземпляров и ускоряют доступ к атрибутам
+@dataclass(slots=True)
 class NutritionRecommendations:
     protein_daily: int = 5  # порций
     vegetables_daily: int = 5  # порций
@@ -10,6 +11,17 @@ class NutritionRecommendations:
     dairy_daily: int = 3  # порций
     grains_daily: int = 6  # порций
 
+    def as_tuple(self) -> Tuple[int, int, int, int, int, int]:
+        """Возвращает нормы в порядке: белки, овощи, жиры, фрукты, молочные продукты, злаки."""
+        return (
+            self.protein_daily,
+            self.vegetables_daily,
+            self.fats_daily,
+            self.fruits_daily,
+            self.dairy_daily,
+            self.grains_daily,
+        )
+
     def update_recommendations(self, new_values: Dict[str, int]):
         """Обновляет нормы на основе входящих данных."""
         for nutrient, value in new_values.items():
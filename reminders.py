@@ -1,24 +1,42 @@
-from datetime import datetime, time
-from telegram.ext import ContextTypes
+from datetime import time
+from zoneinfo import ZoneInfo
+from telegram.ext import ContextTypes, JobQueue
+
+MOSCOW_TZ = ZoneInfo('Europe/Moscow')
+
+# Текст напоминания о приёме пищи
+_REMINDER_TEMPLATE = "Время для {meal}! Не забудьте записать прием пищи в дневник."
 
 class MealReminder:
     def __init__(self):
         self.default_times = {
-            "Завтрак": time(8, 0),
-            "Утренний перекус": time(11, 0),
-            "Обед": time(14, 0),
-            "Обеденный перекус": time(16, 0),
-            "Полдник": time(17, 0),
-            "Ужин": time(19, 0)
+            "Завтрак": time(8, 0, tzinfo=MOSCOW_TZ),
+            "Утренний перекус": time(11, 0, tzinfo=MOSCOW_TZ),
+            "Обед": time(14, 0, tzinfo=MOSCOW_TZ),
+            "Обеденный перекус": time(16, 0, tzinfo=MOSCOW_TZ),
+            "Полдник": time(17, 0, tzinfo=MOSCOW_TZ),
+            "Ужин": time(19, 0, tzinfo=MOSCOW_TZ)
         }
+        # Тексты напоминаний форматируются один раз, а не при каждой отправке
+        self._messages = {meal: _REMINDER_TEMPLATE.format(meal=meal) for meal in self.default_times}
 
-    async def check_and_remind(self, context: ContextTypes.DEFAULT_TYPE):
-        """Проверяет время и отправляет напоминания"""
-        now = datetime.now().time()
-        
+    def schedule_for_chat(self, job_queue: JobQueue, chat_id: int):
+        """
+        Ставит ежедневные напоминания для чата на время каждого приёма пищи.
+        Планировщик будит бота только в эти моменты, без ежеминутной проверки времени.
+        """
         for meal, meal_time in self.default_times.items():
-            if now.hour == meal_time.hour and now.minute == meal_time.minute:
-                await context.bot.send_message(
-                    chat_id=context.job.chat_id,
-                    text=f"Время для {meal}! Не забудьте записать прием пищи в дневник.",
-                ) 
\ No newline at end of file
+            job_queue.run_daily(
+                self._fire,
+                time=meal_time,
+                chat_id=chat_id,
+                name=f"meal_{meal}_{chat_id}",
+                data=meal
+            )
+
+    async def _fire(self, context: ContextTypes.DEFAULT_TYPE):
+        """Отправляет напоминание о приёме пищи, переданном в данных задания"""
+        await context.bot.send_message(
+            chat_id=context.job.chat_id,
+            text=self._messages[context.job.data],
+        )